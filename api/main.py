@@ -1,43 +1,82 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from typing import List
-import chromadb
-from chromadb.config import Settings
-from llama_index.vector_stores.chroma import ChromaVectorStore
-from llama_index.core import StorageContext, VectorStoreIndex
+from typing import Dict, List, Optional, Tuple
+from llama_index.core import Settings
+from chromadb.api.models.Collection import Collection
 from dotenv import load_dotenv
+from loader.embeddings import configure_embed_model, embed_queries
+from loader.normalization import ensure_normalized
+from loader.query_cache import QueryCache
+from loader.chroma_client import get_client, list_shards, query_shards
+from contextlib import asynccontextmanager
+import hashlib
+import time
 import unicodedata
 from multiprocessing import cpu_count
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load the embedding model before serving, so the first search doesn't pay for it."""
+    try:
+        await run_in_threadpool(Settings.embed_model.get_text_embedding, "warmup")
+    except Exception as e:
+        print(f"Embedding model warmup failed: {e}")
+    yield
+
 app = FastAPI(
     title="Vero API",
     description="API for searching and retrieving information from internal documents",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Load environment variables
 load_dotenv()
 print('CPU count:', cpu_count())
 
-# Initialize ChromaDB client
-chroma_client = chromadb.Client(Settings(
-    persist_directory="chroma_db",
-    is_persistent=True
-))
-embeddings_collection = chroma_client.get_or_create_collection(
-    "embeddings",
-    configuration={
-        "hnsw": {
-            "num_threads": 2
-        }
-    }
-)
-vector_store = ChromaVectorStore(chroma_collection=embeddings_collection)
-storage_context = StorageContext.from_defaults(vector_store=vector_store)
+# Queries must be embedded with the same model used at ingestion
+configure_embed_model()
+
+# Retrieval only, no LLM is needed
+Settings.llm = None
+
+# Initialize ChromaDB client, shared with the loader modules
+chroma_client = get_client("chroma_db")
+
+# Collections and their chunk count are listed at most once per SHARD_REFRESH_SECONDS,
+# so collections and chunks added by the loader are picked up after that delay
+SHARD_REFRESH_SECONDS = 60
+_shards: Dict[Optional[str], Tuple[float, List[Collection], int]] = {}
+
+def get_shards(folder_id: Optional[str]) -> Tuple[List[Collection], int]:
+    """Return the collections to search for folder_id, or all collections if None, and their total chunk count."""
+    cached = _shards.get(folder_id)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1], cached[2]
+    
+    shards = list_shards(chroma_client, folder_id)
+    version = sum(shard.count() for shard in shards)
+    _shards[folder_id] = (time.monotonic() + SHARD_REFRESH_SECONDS, shards, version)
+    return shards, version
+
+# Cache of recent search responses
+query_cache = QueryCache(max_size=2000, ttl_seconds=300)
+
+def cache_key(query: str, top_k: int, folder_id: Optional[str], version: int) -> bytes:
+    """
+    Build the cache key for a search.
+    version is the number of chunks searched, so that newly ingested chunks (possibly written by
+    another process) invalidate previously cached results once the collections are refreshed.
+    """
+    key = f"{unicodedata.normalize('NFKC', query)}|{top_k}|{folder_id or ''}|{version}"
+    return hashlib.blake2b(key.encode()).digest()
 
 class SearchQuery(BaseModel):
     query: str
     top_k: int = 3
+    # Only search documents from this Google Drive folder
+    folder_id: Optional[str] = None
     
 class Chunk(BaseModel):
     text: str
@@ -46,6 +85,44 @@ class Chunk(BaseModel):
 class SearchResponse(BaseModel):
     results: List[Chunk]
 
+class BatchSearchQuery(BaseModel):
+    queries: List[str]
+    top_k: int = 3
+    folder_id: Optional[str] = None
+
+def search(query: str, top_k: int, folder_id: Optional[str] = None) -> SearchResponse:
+    """Return the chunks most similar to the query. Blocking, run it in the threadpool."""
+    return search_batch([query], top_k, folder_id)[0]
+
+def search_batch(queries: List[str], top_k: int, folder_id: Optional[str] = None) -> List[SearchResponse]:
+    """
+    Return the chunks most similar to each query, from the collection of folder_id if given,
+    otherwise from all collections. Blocking, run it in the threadpool.
+    """
+    shards, version = get_shards(folder_id)
+    keys = [cache_key(query, top_k, folder_id, version) for query in queries]
+    responses = [query_cache.get(key) for key in keys]
+    
+    misses = [i for i, response in enumerate(responses) if response is None]
+    if misses:
+        # Embed all uncached queries concurrently and search them with one query per collection
+        embeddings = embed_queries([queries[i] for i in misses])
+        matches = query_shards(shards, embeddings, top_k)
+        
+        for i, query_matches in zip(misses, matches):
+            # Normalize chunks stored before ingest-time normalization
+            results = [
+                {
+                    'text': ensure_normalized(text, metadata),
+                    'source': metadata.get('source', 'Unknown'),
+                    'file_name': metadata.get('file_name', 'Unknown')
+                } for _, text, metadata in query_matches]
+            
+            responses[i] = SearchResponse(results=results)
+            query_cache.put(keys[i], responses[i])
+    
+    return responses
+
 @app.post("/internal_search", response_model=SearchResponse)
 async def internal_search(search_query: SearchQuery):
     """
@@ -58,30 +135,39 @@ async def internal_search(search_query: SearchQuery):
         A list of text chunks that are most similar to the query
     """
     try:
-        index = VectorStoreIndex.from_vector_store(
-            vector_store,
-            storage_context=storage_context,
+        # Embedding and Chroma calls are blocking, keep them off the event loop
+        return await run_in_threadpool(search, search_query.query, search_query.top_k, search_query.folder_id)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"An error occurred while searching documents: {str(e)}"
         )
+
+@app.post("/internal_search_batch", response_model=List[SearchResponse])
+async def internal_search_batch(batch_query: BatchSearchQuery):
+    """
+    Search for similar chunks for several queries at once.
+    
+    Args:
+        batch_query: The queries to search for and number of results to return for each query
         
-        # Use retriever instead of query engine
-        retriever = index.as_retriever(similarity_top_k=search_query.top_k)
-        source_nodes = retriever.retrieve(search_query.query)
-        
-        # Extract text content from the source nodes and normalize Unicode characters
-        results = [
-            {
-                'text': unicodedata.normalize('NFKC', node.text), 
-                'source': node.metadata.get('source', 'Unknown'), 
-                'file_name': node.metadata.get('file_name', 'Unknown')
-            } for node in source_nodes]        
-        
-        return SearchResponse(results=results)
+    Returns:
+        One list of similar text chunks per query, in the same order as the queries
+    """
+    try:
+        # Embedding and Chroma calls are blocking, keep them off the event loop
+        return await run_in_threadpool(search_batch, batch_query.queries, batch_query.top_k, batch_query.folder_id)
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"An error occurred while searching documents: {str(e)}"
         )
 
+@app.get("/cache_stats")
+async def cache_stats():
+    """Search cache statistics"""
+    return query_cache.stats()
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
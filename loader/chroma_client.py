@@ -0,0 +1,128 @@
+import functools
+import hashlib
+import heapq
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import chromadb
+import numpy as np
+from chromadb.api import ClientAPI
+from chromadb.api.models.Collection import Collection
+from chromadb.config import Settings as ChromaSettings
+
+# Single collection used before chunks were sharded by Google Drive folder, still searched
+LEGACY_COLLECTION = "embeddings"
+
+# Prefix of the per-folder collections
+SHARD_PREFIX = "emb_"
+
+HNSW_CONFIGURATION = {
+    "hnsw": {
+        # Embeddings are normalized before they are stored or searched, so the inner product
+        # gives the cosine similarity without normalizing on every distance computation
+        "space": "ip",
+        # A denser graph and wider search keep recall high as collections grow past 100K chunks
+        "ef_construction": 128,
+        "max_neighbors": 24,
+        "ef_search": 100,
+        # Single query search stops scaling beyond about 8 threads
+        "num_threads": min(8, os.cpu_count() or 1),
+        # Larger write batches keep inserts fast
+        "batch_size": 1000,
+        "sync_threshold": 10000
+    }
+}
+
+# Parameters that can be changed on an existing collection
+HNSW_RUNTIME_PARAMETERS = ("ef_search", "num_threads", "batch_size", "sync_threshold")
+
+# Shards are searched concurrently, Chroma releases the GIL while querying
+_query_pool = ThreadPoolExecutor(max_workers=8)
+
+@functools.lru_cache(maxsize=None)
+def get_client(persist_directory: str = "chroma_db") -> ClientAPI:
+    """Return the Chroma client for persist_directory, shared by everything in the process."""
+    return chromadb.PersistentClient(
+        path=persist_directory,
+        settings=ChromaSettings(anonymized_telemetry=False)
+    )
+
+def shard_name(folder_id: str) -> str:
+    """Return the name of the collection holding the chunks of a Google Drive folder."""
+    # Drive IDs may contain characters Chroma doesn't accept in names, hash them instead
+    return SHARD_PREFIX + hashlib.sha1(folder_id.encode()).hexdigest()[:16]
+
+@functools.lru_cache(maxsize=None)
+def get_shard(folder_id: str, persist_directory: str = "chroma_db") -> Collection:
+    """Return the collection of a Google Drive folder, creating it on first use."""
+    shard = get_client(persist_directory).get_or_create_collection(
+        shard_name(folder_id),
+        configuration=HNSW_CONFIGURATION,
+        metadata={"folder_id": folder_id},
+    )
+    
+    # Build parameters only apply to new collections, apply the runtime ones to existing collections too
+    shard.modify(configuration={
+        "hnsw": {key: HNSW_CONFIGURATION["hnsw"][key] for key in HNSW_RUNTIME_PARAMETERS}
+    })
+    return shard
+
+def list_shards(client: ClientAPI, folder_id: Optional[str] = None) -> List[Collection]:
+    """
+    Return the collections to search: the shard of folder_id if given, otherwise every shard
+    along with the legacy unsharded collection.
+    """
+    names = {shard_name(folder_id)} if folder_id else None
+    return [
+        collection for collection in client.list_collections()
+        if (collection.name in names if names is not None
+            else collection.name.startswith(SHARD_PREFIX) or collection.name == LEGACY_COLLECTION)
+    ]
+
+def normalize_embeddings(embeddings: Sequence[Sequence[float]]) -> np.ndarray:
+    """Scale embeddings to unit length, as the inner product space expects."""
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+def _cosine_distance(distance: float, space: str) -> float:
+    """
+    Convert a distance to cosine distance so results from collections with different spaces can be merged.
+    Assumes unit length embeddings, which older collections hold too since the supported embedding
+    models produce them.
+    """
+    if space == "l2":
+        # Chroma reports squared L2 distance, which is twice the cosine distance for unit vectors
+        return distance / 2
+    return distance
+
+def query_shards(
+    shards: Sequence[Collection],
+    query_embeddings: List[List[float]],
+    n_results: int,
+) -> List[List[Tuple[float, str, Dict[str, Any]]]]:
+    """
+    Search several collections and merge their results.
+    Returns, for each query embedding, the n_results closest (cosine distance, document, metadata) tuples.
+    """
+    query_embeddings = normalize_embeddings(query_embeddings)
+    
+    def query(shard: Collection) -> List[List[Tuple[float, str, Dict[str, Any]]]]:
+        results = shard.query(
+            query_embeddings=query_embeddings,
+            n_results=n_results,
+            include=["documents", "metadatas", "distances"],
+        )
+        space = (shard.configuration.get("hnsw") or {}).get("space", "l2")
+        return [
+            [(_cosine_distance(distance, space), document, metadata)
+             for distance, document, metadata in zip(distances, documents, metadatas)]
+            for distances, documents, metadatas in zip(results["distances"], results["documents"], results["metadatas"])
+        ]
+
+    merged: List[List[Tuple[float, str, Dict[str, Any]]]] = [[] for _ in query_embeddings]
+    for shard_results in _query_pool.map(query, shards):
+        for matches, shard_matches in zip(merged, shard_results):
+            matches.extend(shard_matches)
+
+    return [heapq.nsmallest(n_results, matches, key=lambda match: match[0]) for matches in merged]
@@ -1,9 +1,11 @@
 import os
 import hashlib
-from typing import Optional
-from sqlalchemy import create_engine, Column, String, DateTime, Boolean
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+from sqlalchemy import create_engine, event, inspect, text, Column, String, DateTime, Boolean
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool
 from datetime import datetime
 
 # Create the base class for declarative models
@@ -15,57 +17,138 @@ class ProcessedFile(Base):
     
     file_path = Column(String, primary_key=True)
     folder_id = Column(String, nullable=False)
-    content_hash = Column(String, nullable=False)
+    content_hash = Column(String, nullable=False, unique=True, index=True)
+    drive_md5 = Column(String, index=True)
     processed_at = Column(DateTime, default=datetime.utcnow)
     is_processed = Column(Boolean, default=True)
     
     def __repr__(self):
         return f"<ProcessedFile(file_path='{self.file_path}', content_hash='{self.content_hash}')>"
 
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Enable WAL so readers don't block on the writer, and tune caching for each new connection."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.close()
+
 class DatabaseManager:
     """Manager class for database operations related to processed files."""
     
     def __init__(self, db_path: str = "processed_files.db"):
         """Initialize the database manager with the specified database path."""
         self.db_path = db_path
-        self.engine = create_engine(f"sqlite:///{db_path}")
-        self.Session = sessionmaker(bind=self.engine)
+        self.engine = create_engine(
+            f"sqlite:///{db_path}",
+            connect_args={"check_same_thread": False},
+            poolclass=QueuePool,
+            pool_size=8,
+            max_overflow=4,
+        )
+        event.listen(self.engine, "connect", _set_sqlite_pragmas)
+        # Keep loaded records usable after their session commits and closes
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
         
         # Create tables if they don't exist
         Base.metadata.create_all(self.engine)
+        
+        # create_all doesn't alter tables that already exist, so add any missing columns and indexes
+        existing_columns = {column["name"] for column in inspect(self.engine).get_columns(ProcessedFile.__tablename__)}
+        if "drive_md5" not in existing_columns:
+            with self.engine.begin() as connection:
+                connection.execute(text(f"ALTER TABLE {ProcessedFile.__tablename__} ADD COLUMN drive_md5 VARCHAR"))
+        
+        for index in ProcessedFile.__table__.indexes:
+            index.create(self.engine, checkfirst=True)
     
     def calculate_file_hash(self, file_path: str) -> str:
         """Calculate SHA-256 hash of a file's content."""
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"File not found: {file_path}")
         
-        sha256_hash = hashlib.sha256()
         with open(file_path, "rb") as f:
-            # Read the file in chunks to handle large files efficiently
-            for byte_block in iter(lambda: f.read(4096), b""):
+            # file_digest (Python 3.11+) reads and hashes in C without a Python-level loop
+            if hasattr(hashlib, "file_digest"):
+                return hashlib.file_digest(f, "sha256").hexdigest()
+            
+            sha256_hash = hashlib.sha256()
+            # Read the file in 1 MiB chunks to handle large files efficiently
+            for byte_block in iter(lambda: f.read(1 << 20), b""):
                 sha256_hash.update(byte_block)
         
         return sha256_hash.hexdigest()
     
-    def is_file_processed(self, content_hash: str) -> bool:
-        """Check if a file has already been processed based on its path or content hash."""
+    @contextmanager
+    def session_scope(self, session: Optional[Session] = None) -> Iterator[Session]:
+        """
+        Provide a session that commits once when the scope exits, and rolls back on errors.
+        If an existing session is passed it is reused, and left to its own scope to commit.
+        """
+        if session is not None:
+            yield session
+            return
+        
         session = self.Session()
-        try:           
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+    
+    def is_file_processed(self, content_hash: str, session: Optional[Session] = None) -> bool:
+        """Check if a file has already been processed based on its path or content hash."""
+        with self.session_scope(session) as session:
             hash_record = session.query(ProcessedFile).filter_by(content_hash=content_hash).first()
             if hash_record:
                 return True
             
             return False
-        finally:
-            session.close()
     
-    def mark_file_processed(self, file_path: str, folder_id: str, content_hash: Optional[str] = None) -> None:
-        """Mark a file as processed in the database."""
-        if content_hash is None:
-            content_hash = self.calculate_file_hash(file_path)
-        
-        session = self.Session()
-        try:
+    def get_processed_content_hashes(self, content_hashes: List[str], session: Optional[Session] = None) -> Dict[str, str]:
+        """Return the folder ID of each already processed content hash, using a single query."""
+        with self.session_scope(session) as session:
+            processed = session.query(ProcessedFile.content_hash, ProcessedFile.folder_id).filter(
+                ProcessedFile.content_hash.in_(content_hashes)
+            ).all()
+            
+            return {row.content_hash: row.folder_id for row in processed}
+    
+    def get_processed_drive_md5s(self, drive_md5s: List[str],
+                                 session: Optional[Session] = None) -> Dict[str, Tuple[str, str]]:
+        """
+        Return the (content_hash, folder_id) of each already processed Google Drive MD5 checksum,
+        using a single query.
+        """
+        with self.session_scope(session) as session:
+            processed = session.query(
+                ProcessedFile.drive_md5, ProcessedFile.content_hash, ProcessedFile.folder_id
+            ).filter(
+                ProcessedFile.drive_md5.in_(drive_md5s)
+            ).all()
+            
+            return {row.drive_md5: (row.content_hash, row.folder_id) for row in processed}
+    
+    def set_drive_md5(self, files: List[Tuple[str, str]], session: Optional[Session] = None) -> None:
+        """Record the Google Drive MD5 checksum of already processed (content_hash, drive_md5) files."""
+        with self.session_scope(session) as session:
+            for content_hash, drive_md5 in files:
+                session.query(ProcessedFile).filter_by(content_hash=content_hash).update(
+                    {ProcessedFile.drive_md5: drive_md5}
+                )
+    
+    def mark_file_processed(self, file_path: str, folder_id: str, content_hash: str,
+                            session: Optional[Session] = None) -> None:
+        """
+        Mark a file as processed in the database.
+        content_hash is the hash computed when the file was checked, so the file isn't read again.
+        """
+        with self.session_scope(session) as session:
             # Check if file is already in the database
             existing_file = session.query(ProcessedFile).filter_by(file_path=file_path).first()
             
@@ -83,18 +166,47 @@ class DatabaseManager:
                     content_hash=content_hash
                 )
                 session.add(new_file)
+    
+    def mark_files_processed(self, files: List[Tuple[str, str, str, Optional[str]]],
+                             session: Optional[Session] = None) -> None:
+        """
+        Mark a batch of files as processed in a single commit.
+        Takes (file_path, folder_id, content_hash, drive_md5) tuples, drive_md5 may be None.
+        """
+        processed_at = datetime.utcnow()
+        
+        # Keep the last entry per file path, like repeated mark_file_processed calls would
+        rows = {
+            file_path: {
+                "file_path": file_path,
+                "folder_id": folder_id,
+                "content_hash": content_hash,
+                "drive_md5": drive_md5,
+                "processed_at": processed_at,
+                "is_processed": True,
+            }
+            for file_path, folder_id, content_hash, drive_md5 in files
+        }
+        
+        with self.session_scope(session) as session:
+            # Check which files are already in the database
+            existing_paths = {
+                row.file_path for row in session.query(ProcessedFile.file_path).filter(
+                    ProcessedFile.file_path.in_(list(rows))
+                )
+            }
             
-            session.commit()
-        finally:
-            session.close()
+            session.bulk_update_mappings(
+                ProcessedFile, [row for path, row in rows.items() if path in existing_paths]
+            )
+            session.bulk_insert_mappings(
+                ProcessedFile, [row for path, row in rows.items() if path not in existing_paths]
+            )
     
-    def get_processed_files(self, folder_id: Optional[str] = None) -> list:
+    def get_processed_files(self, folder_id: Optional[str] = None, session: Optional[Session] = None) -> list:
         """Get all processed files, optionally filtered by folder_id."""
-        session = self.Session()
-        try:
+        with self.session_scope(session) as session:
             query = session.query(ProcessedFile)
             if folder_id:
                 query = query.filter_by(folder_id=folder_id)
             return query.all()
-        finally:
-            session.close() 
\ No newline at end of file
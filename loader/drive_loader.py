@@ -1,63 +1,161 @@
+import functools
 import os
-from typing import List, Callable
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import islice
+from typing import Iterator, List, Callable, Optional, Tuple
 from dotenv import load_dotenv
+import httplib2
 from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
-import io
 
 load_dotenv()
 
+# Number of files downloaded from Drive in parallel
+MAX_DOWNLOAD_WORKERS = int(os.getenv("DRIVE_DOWNLOAD_WORKERS", "8"))
+
+# Number of downloaded files handed to the processor at once
+DOWNLOAD_BATCH_SIZE = int(os.getenv("DRIVE_BATCH_SIZE", "32"))
+
+# Bytes fetched per HTTP range request when downloading a file; bounds the memory each
+# download holds at once (the client library default is 100 MiB)
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Drive services are cached per thread, since their HTTP connections are not thread-safe
+_thread_local = threading.local()
+
+@functools.lru_cache(maxsize=None)
+def _load_credentials(credentials_path: str, scopes: Tuple[str, ...]):
+    """Load service account credentials once per key file and scopes."""
+    return service_account.Credentials.from_service_account_file(
+        credentials_path, 
+        scopes=list(scopes)
+    )
+
+def get_drive_service(credentials_path: str, scopes: List[str]):
+    """
+    Return the current thread's Google Drive service for the given credentials, building it on first use.
+    The service reuses one keep-alive HTTP connection and the discovery document bundled with the client library.
+    """
+    if not hasattr(_thread_local, 'services'):
+        _thread_local.services = {}
+    
+    key = (credentials_path, tuple(scopes))
+    if key not in _thread_local.services:
+        authed_http = AuthorizedHttp(_load_credentials(*key), http=httplib2.Http())
+        _thread_local.services[key] = build(
+            'drive', 'v3',
+            http=authed_http,
+            cache_discovery=False,
+            static_discovery=True
+        )
+    return _thread_local.services[key]
+
 class GoogleDriveLoader:
     def __init__(self, credentials_path: str = "./loader/credentials.json", scopes: List[str] = None):
         """Initialize the Google Drive loader with service account credentials."""
         self.credentials_path = credentials_path
         self.scopes = scopes or ['https://www.googleapis.com/auth/drive.readonly']
-        self.service = self._get_drive_service()
+        
+        # Build the service up front so credential problems surface immediately
+        self._get_drive_service()
+    
+    @property
+    def service(self):
+        """Return the Drive service for the current thread."""
+        return self._get_drive_service()
         
     def _get_drive_service(self):
         """Set up and return Google Drive service using service account credentials."""
-        credentials = service_account.Credentials.from_service_account_file(
-            self.credentials_path, 
-            scopes=self.scopes
-        )
-        return build('drive', 'v3', credentials=credentials)
+        return get_drive_service(self.credentials_path, self.scopes)
     
-    def list_pdfs_in_folder(self, folder_id: str) -> List[dict]:
-        """List all PDF files in the specified folder."""
-        results = self.service.files().list(
-            q=f"'{folder_id}' in parents and mimeType='application/pdf'",
-            fields="files(id, name)"
-        ).execute()
-        
-        return results.get('files', [])
+    def list_pdfs_in_folder(self, folder_id: str) -> Iterator[dict]:
+        """
+        List all PDF files in the specified folder.
+        Files are yielded page by page as they are listed, so callers can start on the first page
+        while the next one is requested.
+        """
+        page_token = None
+        while True:
+            results = self.service.files().list(
+                q=f"'{folder_id}' in parents and mimeType='application/pdf'",
+                fields="nextPageToken, files(id, name, md5Checksum, size)",
+                pageSize=1000,
+                pageToken=page_token
+            ).execute()
+            
+            yield from results.get('files', [])
+            
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
     
     def download_file(self, file_id: str, output_path: str) -> str:
         """Download a file from Google Drive and return the local path."""
         request = self.service.files().get_media(fileId=file_id)
-        fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, request)
         
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
+        # Stream straight to disk instead of buffering the whole file in memory
+        with open(output_path, 'wb') as fh:
+            downloader = MediaIoBaseDownload(fh, request, chunksize=DOWNLOAD_CHUNK_SIZE)
             
-        # Save the file
-        fh.seek(0)
-        with open(output_path, 'wb') as f:
-            f.write(fh.read())
+            done = False
+            while done is False:
+                status, done = downloader.next_chunk()
             
         return output_path
     
-    def process_folder(self, folder_id: str, output_dir: str, file_processor: Callable[[str, str], bool]) -> None:
+    def _submit_downloads(self, pool: ThreadPoolExecutor, pdfs, output_dir: str) -> List[tuple]:
+        """
+        Schedule file downloads and return (pdf, future) pairs.
+        Each file gets its own subdirectory so files with the same name don't collide.
+        """
+        downloads = []
+        for pdf in pdfs:
+            download_dir = os.path.join(output_dir, pdf['id'])
+            os.makedirs(download_dir, exist_ok=True)
+            future = pool.submit(self.download_file, pdf['id'], os.path.join(download_dir, pdf['name']))
+            downloads.append((pdf, future))
+        return downloads
+    
+    def _remove_downloads(self, downloads: List[tuple], output_dir: str) -> None:
+        """Delete downloaded files, cancelling downloads that haven't started yet."""
+        for pdf, future in downloads:
+            future.cancel()
+        for pdf, future in downloads:
+            if not future.cancelled():
+                # Wait for running downloads so their files can be removed
+                wait([future])
+            shutil.rmtree(os.path.join(output_dir, pdf['id']), ignore_errors=True)
+    
+    def process_folder(self, folder_id: str, output_dir: str,
+                       file_processor: Callable[[List[Tuple[str, str, Optional[str]]], str], List[bool]],
+                       on_complete: Optional[Callable[[], None]] = None,
+                       file_filter: Optional[Callable[[List[dict], str], List[dict]]] = None,
+                       max_workers: int = MAX_DOWNLOAD_WORKERS,
+                       batch_size: int = DOWNLOAD_BATCH_SIZE) -> None:
         """
         Download files from a folder, process them using the provided processor, and clean up.
         
+        Files are downloaded in parallel and handed to file_processor in batches, while the next
+        batch downloads. file_processor is always called from the calling thread so writes stay
+        serialized.
+        
         Args:
             folder_id: The Google Drive folder ID
             output_dir: Directory to temporarily store downloaded files
-            file_processor: A function that takes (local_path, folder_id) and returns a boolean
-                           indicating whether the file was processed (True) or skipped (False)
+            file_processor: A function that takes a list of (local_path, source, drive_md5) tuples and
+                           the folder ID, and returns a list of booleans indicating whether each file
+                           was processed (True) or skipped (False)
+            on_complete: Optional function called once every file has been handed to file_processor,
+                         e.g. to flush batched writes
+            file_filter: Optional function that takes a batch of the folder's file listings (with id,
+                         name, md5Checksum and size) and the folder ID, and returns the ones that
+                         need to be downloaded
+            max_workers: Maximum number of files downloaded at the same time
+            batch_size: Number of files handed to file_processor at once
         """
         # Create output directory if it doesn't exist
         os.makedirs(output_dir, exist_ok=True)
@@ -65,26 +163,52 @@ class GoogleDriveLoader:
         processed_count = 0
         skipped_count = 0
         
+        def list_new_pdfs() -> Iterator[dict]:
+            """Yield the folder's PDFs as they are listed, skipping known files before downloading them."""
+            nonlocal skipped_count
+            pdfs = iter(self.list_pdfs_in_folder(folder_id))
+            while True:
+                listed = list(islice(pdfs, batch_size))
+                if not listed:
+                    return
+                
+                new_pdfs = file_filter(listed, folder_id) if file_filter is not None else listed
+                skipped_count += len(listed) - len(new_pdfs)
+                yield from new_pdfs
+        
         try:
-            # Get list of PDFs
-            pdfs = self.list_pdfs_in_folder(folder_id)
+            # Listing continues while the previous batches download
+            pdfs = list_new_pdfs()
             
-            # Process each PDF
-            for pdf in pdfs:
-                output_path = os.path.join(output_dir, pdf['name'])
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                current = self._submit_downloads(pool, islice(pdfs, batch_size), output_dir)
+                upcoming = []
+                
                 try:
-                    # Download the file
-                    local_path = self.download_file(pdf['id'], output_path)
-                    # Process the file
-                    was_processed = file_processor(local_path, f'https://drive.google.com/file/d/{pdf["id"]}/view')
-                    if was_processed:
-                        processed_count += 1
-                    else:
-                        skipped_count += 1
+                    while current:
+                        # Start downloading the next batch while this one is processed
+                        upcoming = self._submit_downloads(pool, islice(pdfs, batch_size), output_dir)
+                        
+                        files = [
+                            (future.result(), f'https://drive.google.com/file/d/{pdf["id"]}/view', pdf.get('md5Checksum'))
+                            for pdf, future in current
+                        ]
+                        
+                        # Process the files
+                        for was_processed in file_processor(files, folder_id):
+                            if was_processed:
+                                processed_count += 1
+                            else:
+                                skipped_count += 1
+                        
+                        self._remove_downloads(current, output_dir)
+                        current, upcoming = upcoming, []
                 finally:
-                    # Always delete the file after processing, even if processing fails
-                    if os.path.exists(output_path):
-                        os.remove(output_path)
+                    # Always delete the files after processing, even if processing fails
+                    self._remove_downloads(current + upcoming, output_dir)
+            
+            if on_complete is not None:
+                on_complete()
             
             print(f"Processing complete: {processed_count} files processed, {skipped_count} files skipped")
                 
@@ -107,5 +231,12 @@ if __name__ == "__main__":
     folder_id = "16QhQl_DD79M_2UEXIwPvFQKikwqZsyda"
     output_dir = "downloaded_pdfs"
     
-    # Use the process_pdf method from PDFProcessor as the callback
-    loader.process_folder(folder_id, output_dir, processor.process_pdf)
\ No newline at end of file
+    # Use the process_pdfs method from PDFProcessor as the callback and flush the last batch at the end
+    # Files whose Drive checksum was already processed are skipped without downloading
+    loader.process_folder(
+        folder_id,
+        output_dir,
+        processor.process_pdfs,
+        on_complete=processor.flush_batch,
+        file_filter=processor.filter_new_drive_files,
+    )
\ No newline at end of file
@@ -0,0 +1,35 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from llama_index.core import Settings
+
+def configure_embed_model() -> None:
+    """
+    Set up the embedding model shared by ingestion and search.
+    EMBED_MODEL selects a local HuggingFace model (e.g. BAAI/bge-small-en-v1.5) that embeds in batches of
+    EMBED_BATCH_SIZE on EMBED_DEVICE (CUDA when available by default). When unset, the llama-index default
+    model is used, resolved on first use so that importing doesn't require its API key.
+    Ingestion and search must use the same model.
+    """
+    model_name = os.getenv("EMBED_MODEL")
+    if model_name:
+        # Optional dependency, only needed for local models
+        from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+        Settings.embed_model = HuggingFaceEmbedding(
+            model_name=model_name,
+            device=os.getenv("EMBED_DEVICE"),
+            embed_batch_size=int(os.getenv("EMBED_BATCH_SIZE", "64")),
+        )
+
+# Query embeddings are computed one call per query, these calls run concurrently
+_query_embedding_pool = ThreadPoolExecutor(max_workers=8)
+
+def embed_queries(queries: List[str]) -> List[List[float]]:
+    """
+    Embed search queries in query mode (some models prepend a query instruction), concurrently
+    so that a batch of queries takes about as long as a single one.
+    """
+    if len(queries) == 1:
+        return [Settings.embed_model.get_query_embedding(queries[0])]
+    return list(_query_embedding_pool.map(Settings.embed_model.get_query_embedding, queries))
@@ -0,0 +1,89 @@
+from typing import Any, Dict, List, Sequence
+import numpy as np
+from chromadb.api.models.Collection import Collection
+from chroma_client import normalize_embeddings
+
+# Chunks exported from Chroma per request
+EXPORT_PAGE_SIZE = 5000
+
+# Metadata kept in memory for search results, the rest (notably the serialized node) is dropped
+SEARCH_METADATA_KEYS = ("nfkc", "source", "file_name")
+
+class FaissIndex:
+    """
+    In-memory FAISS copy of a Chroma collection, with 8-bit scalar quantized vectors or, when
+    quantized is False, full precision ones.
+    Its query() mirrors Collection.query, so it can be searched in place of the collection, returning
+    only the SEARCH_METADATA_KEYS of each chunk's metadata.
+    """
+
+    def __init__(self, collection: Collection, max_neighbors: int = 24, ef_construction: int = 128,
+                 ef_search: int = 100, quantized: bool = True):
+        """Export the collection's embeddings, documents and metadata and build the index."""
+        # Optional dependency, only needed when the FAISS index is enabled
+        import faiss
+
+        self.name = collection.name
+        self.documents: List[str] = []
+        self.metadatas: List[Dict[str, Any]] = []
+        vectors = []
+        for offset in range(0, collection.count(), EXPORT_PAGE_SIZE):
+            page = collection.get(
+                limit=EXPORT_PAGE_SIZE,
+                offset=offset,
+                include=["embeddings", "documents", "metadatas"],
+            )
+            vectors.extend(page["embeddings"])
+            self.documents.extend(page["documents"])
+            for metadata in page["metadatas"]:
+                metadata = metadata or {}
+                self.metadatas.append({key: metadata[key] for key in SEARCH_METADATA_KEYS if key in metadata})
+
+        self.index = None
+        if vectors:
+            # Collections in other spaces may hold vectors that aren't unit length
+            vectors = normalize_embeddings(vectors)
+
+            # FAISS picks the widest SIMD distance kernels the CPU supports (AVX2, AVX-512, NEON) at load time
+            if quantized:
+                self.index = faiss.IndexHNSWSQ(
+                    vectors.shape[1], faiss.ScalarQuantizer.QT_8bit, max_neighbors, faiss.METRIC_INNER_PRODUCT
+                )
+            else:
+                self.index = faiss.IndexHNSWFlat(vectors.shape[1], max_neighbors, faiss.METRIC_INNER_PRODUCT)
+            self.index.hnsw.efConstruction = ef_construction
+            self.index.hnsw.efSearch = ef_search
+            self.index.train(vectors)
+            self.index.add(vectors)
+
+        # Vectors are normalized, so distances are reported like an inner product collection
+        self.configuration = {"hnsw": {"space": "ip"}}
+
+    def count(self) -> int:
+        """Return the number of chunks in the index."""
+        return len(self.documents)
+
+    def query(self, query_embeddings: Sequence[Sequence[float]], n_results: int,
+              include: Sequence[str] = ("documents", "metadatas", "distances")) -> Dict[str, Any]:
+        """
+        Return the n_results nearest chunks for each unit length query embedding, in Chroma's result format.
+        Documents, metadata and distances are always included.
+        """
+        if n_results <= 0:
+            raise ValueError(f"n_results must be a positive integer, got {n_results}")
+        
+        results: Dict[str, Any] = {"distances": [], "documents": [], "metadatas": []}
+        if self.index is None:
+            for _ in query_embeddings:
+                for key in results:
+                    results[key].append([])
+            return results
+
+        scores, positions = self.index.search(np.asarray(query_embeddings, dtype=np.float32), n_results)
+        for query_scores, query_positions in zip(scores, positions):
+            # FAISS pads with -1 when there are fewer than n_results chunks
+            found = [(score, position) for score, position in zip(query_scores, query_positions) if position >= 0]
+            results["distances"].append([1 - float(score) for score, _ in found])
+            results["documents"].append([self.documents[position] for _, position in found])
+            results["metadatas"].append([self.metadatas[position] for _, position in found])
+        return results
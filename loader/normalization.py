@@ -0,0 +1,18 @@
+import unicodedata
+from typing import Any, Dict
+
+# Version of the text normalization applied at ingest, stored in each chunk's metadata
+NFKC_VERSION = 1
+
+def normalize_text(text: str) -> str:
+    """Return the NFKC normalized form of text."""
+    return unicodedata.normalize('NFKC', text)
+
+def ensure_normalized(text: str, metadata: Dict[str, Any]) -> str:
+    """
+    Return chunk text in NFKC form.
+    Chunks ingested with normalization are returned as is, older chunks are normalized on the fly.
+    """
+    if metadata.get("nfkc") == NFKC_VERSION:
+        return text
+    return normalize_text(text)
@@ -0,0 +1,40 @@
+from dotenv import load_dotenv
+from chroma_client import get_client, list_shards
+from normalization import NFKC_VERSION, normalize_text
+
+load_dotenv()
+
+# Chunks read and rewritten per request
+PAGE_SIZE = 1000
+
+def normalize_chroma_db(persist_directory: str = "chroma_db") -> None:
+    """
+    Rewrite chunks stored before ingest-time normalization in NFKC form, so searches
+    don't have to normalize them on the fly.
+    """
+    for collection in list_shards(get_client(persist_directory)):
+        updated = 0
+        for offset in range(0, collection.count(), PAGE_SIZE):
+            page = collection.get(limit=PAGE_SIZE, offset=offset, include=["embeddings", "documents", "metadatas"])
+            
+            ids, embeddings, documents, metadatas = [], [], [], []
+            for chunk_id, embedding, document, metadata in zip(
+                page["ids"], page["embeddings"], page["documents"], page["metadatas"]
+            ):
+                if metadata.get("nfkc") == NFKC_VERSION:
+                    continue
+                ids.append(chunk_id)
+                embeddings.append(embedding)
+                documents.append(normalize_text(document))
+                metadatas.append({**metadata, "nfkc": NFKC_VERSION})
+            
+            # Embeddings are kept as they are, normalization doesn't change the meaning of the text.
+            # They must be passed, otherwise Chroma re-embeds the documents with its default model
+            if ids:
+                collection.update(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+                updated += len(ids)
+        
+        print(f"{collection.name}: normalized {updated} of {collection.count()} chunks")
+
+if __name__ == "__main__":
+    normalize_chroma_db()
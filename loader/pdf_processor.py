@@ -1,110 +1,281 @@
+import json
 import os
-from typing import List
+from typing import Dict, List, Optional, Tuple
+import numpy as np
 from dotenv import load_dotenv
 from llama_index.core import (
-    VectorStoreIndex,
     SimpleDirectoryReader,
-    StorageContext,
+    Settings,
+    Document,
 )
-from llama_index.vector_stores.chroma.base import ChromaVectorStore
-import chromadb
-from chromadb.config import Settings as ChromaSettings
+from llama_index.core.ingestion import run_transformations
+from llama_index.core.schema import BaseNode, MetadataMode
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
 from db_manager import DatabaseManager
-import unicodedata
+from embeddings import configure_embed_model
+from normalization import NFKC_VERSION, ensure_normalized, normalize_text
+from pdf_text import extract_page_texts
+from chroma_client import get_client, get_shard, list_shards, normalize_embeddings, query_shards
 
 load_dotenv()
+configure_embed_model()
+
+# Number of chunks embedded and written to Chroma per flush
+BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "200"))
 
 class PDFProcessor:
-    def __init__(self, persist_directory: str = "chroma_db"):
+    def __init__(self, persist_directory: str = "chroma_db", batch_size: int = BATCH_SIZE):
         """Initialize the PDF processor with vector store configuration."""
         self.persist_directory = persist_directory
+        self.batch_size = batch_size
         self._setup_vector_store()
         self.db_manager = DatabaseManager()
         
-    def _setup_vector_store(self):
-        """Set up the Chroma vector store."""
-        # Initialize Chroma client
-        chroma_client = chromadb.PersistentClient(
-            path=self.persist_directory,
-            settings=ChromaSettings(anonymized_telemetry=False)
-        )
-        
-        # Create or get the collection
-        self.embeddings_collection = chroma_client.get_or_create_collection(
-            "embeddings",
-            configuration={
-                "hnsw": {
-                    "num_threads": 2
-                }
-            }
-        )
-        
-        # Create vector store
-        self.vector_store = ChromaVectorStore(chroma_collection=self.embeddings_collection)
-        
-        # Create storage context
-        self.storage_context = StorageContext.from_defaults(
-            vector_store=self.vector_store
-        )
-    
-    def process_pdf(self, local_path: str, source: str) -> bool:
-        """
-        Process a single PDF file and store its embeddings.
-        Returns True if the file was processed, False if it was skipped due to duplication.
-        """
-        if not os.path.exists(local_path):
-            raise FileNotFoundError(f"PDF file not found: {local_path}")
-            
-        if not local_path.lower().endswith('.pdf'):
-            raise ValueError(f"File is not a PDF: {local_path}")
+        # Parsed nodes waiting to be embedded, and the files they came from
+        self._buffer: List[BaseNode] = []
+        self._pending_files: List[Tuple[str, str, str, Optional[str]]] = []
         
-        # Calculate content hash
-        content_hash = self.db_manager.calculate_file_hash(local_path)
+        # Drive checksums to record for files processed before checksums were tracked
+        self._pending_drive_md5s: List[Tuple[str, str]] = []
         
-        # Check if file has already been processed
-        if self.db_manager.is_file_processed(content_hash):
-            print(f"Skipping {local_path} - already processed")
-            return False
+        # (content_hash, folder_id) of files skipped as duplicates, their chunks may only be
+        # stored in another folder's collection
+        self._pending_copies: List[Tuple[str, str]] = []
         
+    def _setup_vector_store(self):
+        """Set up the Chroma client, chunks are stored in one collection per Google Drive folder."""
+        self.chroma_client = get_client(self.persist_directory)
+    
+    def load_pdf(self, local_path: str) -> List[Document]:
+        """Load a PDF as one document per page, using PDFium and falling back to the default reader."""
+        try:
+            page_texts = extract_page_texts(local_path)
+        except Exception as e:
+            print(f"PDFium could not read {local_path} ({e}), falling back to the default reader")
+            return SimpleDirectoryReader(
+                input_files=[local_path]
+            ).load_data()
+        
+        return [
+            Document(
+                text=text,
+                metadata={"page_label": str(page_number), "file_name": os.path.basename(local_path)},
+                # Same as the default reader, the file name is not part of the embedded text
+                excluded_embed_metadata_keys=["file_name"],
+                excluded_llm_metadata_keys=["file_name"],
+            )
+            for page_number, text in enumerate(page_texts, start=1)
+        ]
+    
+    def parse_pdf(self, local_path: str, source: str, folder_id: str, content_hash: str) -> List[BaseNode]:
+        """Parse a single PDF into chunked nodes ready for embedding."""
         # Get file information
-        file_name = os.path.basename(local_path)
+        file_name = normalize_text(os.path.basename(local_path))
         
         # Load the PDF
-        documents = SimpleDirectoryReader(
-            input_files=[local_path]
-        ).load_data()
+        documents = self.load_pdf(local_path)
         
-        # Add file information to each document's metadata
         for doc in documents:
+            # Normalize Unicode characters once here instead of on every search
+            doc.set_content(normalize_text(doc.text))
+            
+            # Add file information to each document's metadata
             doc.metadata["source"] = source
+            doc.metadata["folder_id"] = folder_id
             doc.metadata["file_name"] = file_name
             doc.metadata["content_hash"] = content_hash
+            doc.metadata["nfkc"] = NFKC_VERSION
+            doc.excluded_embed_metadata_keys.extend(["folder_id", "nfkc"])
+            doc.excluded_llm_metadata_keys.extend(["folder_id", "nfkc"])
+        
+        # Split into chunks the same way VectorStoreIndex.from_documents would
+        return run_transformations(documents, Settings.transformations)
+    
+    def filter_new_drive_files(self, files: List[dict], folder_id: str) -> List[dict]:
+        """
+        Drop Google Drive files whose MD5 checksum matches an already processed file,
+        so they don't need to be downloaded. Their chunks are copied to folder_id's
+        collection on the next flush if they were processed from another folder.
+        """
+        drive_md5s = [file['md5Checksum'] for file in files if file.get('md5Checksum')]
+        processed = self.db_manager.get_processed_drive_md5s(drive_md5s)
+        
+        new_files = []
+        for file in files:
+            if file.get('md5Checksum') in processed:
+                print(f"Skipping {file['name']} - already processed")
+                content_hash, processed_folder_id = processed[file['md5Checksum']]
+                if processed_folder_id != folder_id:
+                    self._pending_copies.append((content_hash, folder_id))
+            else:
+                new_files.append(file)
+        return new_files
+    
+    def process_pdfs(self, files: List[Tuple[str, str, Optional[str]]], folder_id: str) -> List[bool]:
+        """
+        Parse a batch of PDFs from a Google Drive folder and queue their chunks for embedding.
+        Takes (local_path, source, drive_md5) tuples, where drive_md5 is the file's Google Drive
+        MD5 checksum if known, and returns, for each file, True if it was processed or False if
+        it was skipped due to duplication. Skipped files processed from another folder have their
+        chunks copied to folder_id's collection on the next flush.
+        Call flush_batch() once all files are queued to write any remaining chunks.
+        """
+        for local_path, _, _ in files:
+            if not os.path.exists(local_path):
+                raise FileNotFoundError(f"PDF file not found: {local_path}")
+                
+            if not local_path.lower().endswith('.pdf'):
+                raise ValueError(f"File is not a PDF: {local_path}")
+        
+        # Calculate content hashes and check the whole batch against the database in one query
+        content_hashes = [self.db_manager.calculate_file_hash(local_path) for local_path, _, _ in files]
+        processed = self.db_manager.get_processed_content_hashes(content_hashes)
+        
+        # Files waiting in the current batch are not in the database yet
+        pending = {file_hash: file_folder_id for _, file_folder_id, file_hash, _ in self._pending_files}
         
-        # Create index and store embeddings
-        index = VectorStoreIndex.from_documents(
-            documents,
-            storage_context=self.storage_context,
-        )
+        results = []
+        for (local_path, source, drive_md5), content_hash in zip(files, content_hashes):
+            if content_hash in processed or content_hash in pending:
+                print(f"Skipping {local_path} - already processed")
+                results.append(False)
+                
+                # Only files processed from another folder need their chunks copied
+                processed_folder_id = processed.get(content_hash, pending.get(content_hash))
+                if processed_folder_id != folder_id:
+                    self._pending_copies.append((content_hash, folder_id))
+                
+                # Remember the checksum of files processed before it was recorded, so the
+                # next sync can skip them without downloading
+                if drive_md5 and content_hash not in pending:
+                    self._pending_drive_md5s.append((content_hash, drive_md5))
+                continue
+            
+            # Skip later copies of the same content within this batch
+            pending[content_hash] = folder_id
+            
+            self._buffer.extend(self.parse_pdf(local_path, source, folder_id, content_hash))
+            self._pending_files.append((os.path.basename(local_path), folder_id, content_hash, drive_md5))
+            
+            if len(self._buffer) >= self.batch_size:
+                self.flush_batch()
+            
+            print(f"Processed {local_path} successfully")
+            results.append(True)
+        
+        return results
+    
+    def process_pdf(self, local_path: str, source: str, folder_id: str) -> bool:
+        """
+        Parse a single PDF from a Google Drive folder and queue its chunks for embedding.
+        Returns True if the file was processed, False if it was skipped due to duplication.
+        Call flush_batch() once all files are queued to write any remaining chunks.
+        """
+        return self.process_pdfs([(local_path, source, None)], folder_id)[0]
+    
+    def flush_batch(self) -> None:
+        """
+        Embed all buffered chunks, write them to their folder's collection and mark their files as processed.
+        All database updates of the batch are written in a single commit.
+        """
+        for start in range(0, len(self._buffer), self.batch_size):
+            batch = self._buffer[start:start + self.batch_size]
+            
+            # One embedding call per batch and one Chroma write per folder
+            embeddings = normalize_embeddings(Settings.embed_model.get_text_embedding_batch(
+                [node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch]
+            ))
+            by_folder: Dict[str, List[Tuple[BaseNode, np.ndarray]]] = {}
+            for node, embedding in zip(batch, embeddings):
+                by_folder.setdefault(node.metadata["folder_id"], []).append((node, embedding))
+            
+            for folder_id, entries in by_folder.items():
+                get_shard(folder_id, self.persist_directory).add(
+                    ids=[node.node_id for node, _ in entries],
+                    embeddings=[embedding for _, embedding in entries],
+                    metadatas=[
+                        node_to_metadata_dict(node, remove_text=True, flat_metadata=True)
+                        for node, _ in entries
+                    ],
+                    documents=[node.get_content(metadata_mode=MetadataMode.NONE) for node, _ in entries],
+                )
         
-        # Mark file as processed in the database
-        self.db_manager.mark_file_processed(file_name, source, content_hash)
+        # Pending files are stored now, so duplicates of them can be copied too
+        if self._pending_copies:
+            self._copy_duplicates(self._pending_copies)
         
-        print(f"Processed {local_path} successfully")
-        return True
+        # Only mark files once all of their chunks are stored
+        with self.db_manager.session_scope() as session:
+            if self._pending_files:
+                self.db_manager.mark_files_processed(self._pending_files, session=session)
+            if self._pending_drive_md5s:
+                self.db_manager.set_drive_md5(self._pending_drive_md5s, session=session)
         
-    def get_similar_chunks(self, query: str, top_k: int = 3) -> List:
-        """Retrieve similar chunks based on a query and return their text content."""
-        index = VectorStoreIndex.from_vector_store(
-            self.vector_store,
-            storage_context=self.storage_context,
-        )
+        self._buffer = []
+        self._pending_files = []
+        self._pending_drive_md5s = []
+        self._pending_copies = []
+    
+    def _copy_duplicates(self, copies: List[Tuple[str, str]]) -> None:
+        """
+        Copy the chunks of already processed files to the collections of the folders they were
+        found in again, with their stored embeddings, so searches within those folders find them.
+        Takes (content_hash, folder_id) tuples, files already in the folder's collection are left as is.
+        """
+        by_folder: Dict[str, List[str]] = {}
+        for content_hash, folder_id in copies:
+            by_folder.setdefault(folder_id, []).append(content_hash)
         
-        # Use retriever instead of query engine
-        retriever = index.as_retriever(similarity_top_k=top_k)
-        source_nodes = retriever.retrieve(query)
+        for folder_id, content_hashes in by_folder.items():
+            target = get_shard(folder_id, self.persist_directory)
+            stored = target.get(where={"content_hash": {"$in": content_hashes}}, include=["metadatas"])
+            missing = set(content_hashes) - {metadata["content_hash"] for metadata in stored["metadatas"]}
+            
+            for shard in list_shards(self.chroma_client):
+                if not missing:
+                    break
+                if shard.name == target.name:
+                    continue
+                
+                found = shard.get(
+                    where={"content_hash": {"$in": sorted(missing)}},
+                    include=["embeddings", "documents", "metadatas"],
+                )
+                if not found["ids"]:
+                    continue
+                
+                metadatas = [self._with_folder_id(metadata, folder_id) for metadata in found["metadatas"]]
+                # Older collections may hold vectors that aren't unit length
+                target.add(
+                    ids=found["ids"],
+                    embeddings=normalize_embeddings(found["embeddings"]),
+                    metadatas=metadatas,
+                    documents=found["documents"],
+                )
+                missing -= {metadata["content_hash"] for metadata in metadatas}
+                print(f"Copied {len(found['ids'])} chunks of already processed files to folder {folder_id}")
+    
+    @staticmethod
+    def _with_folder_id(metadata: dict, folder_id: str) -> dict:
+        """Return a copy of a stored chunk's metadata assigned to folder_id."""
+        metadata = dict(metadata, folder_id=folder_id)
+        # The serialized node carries its own copy of the metadata
+        if "_node_content" in metadata:
+            node_content = json.loads(metadata["_node_content"])
+            node_content.setdefault("metadata", {})["folder_id"] = folder_id
+            metadata["_node_content"] = json.dumps(node_content)
+        return metadata
+        
+    def get_similar_chunks(self, query: str, top_k: int = 3, folder_id: Optional[str] = None) -> List:
+        """
+        Retrieve similar chunks based on a query and return their text content.
+        Searches the collection of folder_id if given, otherwise all collections.
+        """
+        query_embedding = Settings.embed_model.get_query_embedding(query)
+        matches = query_shards(list_shards(self.chroma_client, folder_id), [query_embedding], top_k)[0]
         
-        # Extract text content from the source nodes and normalize Unicode characters
-        chunk_texts = [unicodedata.normalize('NFKC', node.text) for node in source_nodes]
+        # Normalize chunks stored before ingest-time normalization
+        chunk_texts = [ensure_normalized(document, metadata) for _, document, metadata in matches]
         
         return chunk_texts
 
@@ -113,6 +284,6 @@ if __name__ == "__main__":
     processor = PDFProcessor()
     print(processor.get_similar_chunks("What is Bakra Beverage"))
     # Process a single PDF
-    # processor.process_pdf("path/to/your/pdf")
+    # processor.process_pdf("path/to/your/pdf", "source", "folder_id")
     # Process a directory of PDFs
     # processor.process_directory("path/to/your/pdf/directory") 
\ No newline at end of file
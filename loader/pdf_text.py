@@ -0,0 +1,47 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+import pypdfium2 as pdfium
+
+# PDFs with more pages than this are split across worker processes
+PARALLEL_PAGE_THRESHOLD = 200
+
+def _extract_page_range(local_path: str, start: int, stop: int) -> List[str]:
+    """Extract the text of pages start to stop (exclusive) with PDFium."""
+    pdf = pdfium.PdfDocument(local_path)
+    try:
+        texts = []
+        for index in range(start, stop):
+            page = pdf[index]
+            textpage = page.get_textpage()
+            # PDFium separates lines with CRLF
+            texts.append(textpage.get_text_range().replace("\r\n", "\n"))
+            textpage.close()
+            page.close()
+        return texts
+    finally:
+        pdf.close()
+
+def extract_page_texts(local_path: str) -> List[str]:
+    """
+    Extract the text of every page of a PDF with PDFium.
+    Large PDFs are split into page ranges extracted in parallel worker processes.
+    """
+    pdf = pdfium.PdfDocument(local_path)
+    try:
+        page_count = len(pdf)
+    finally:
+        pdf.close()
+
+    workers = os.cpu_count() or 1
+    if page_count <= PARALLEL_PAGE_THRESHOLD or workers == 1:
+        return _extract_page_range(local_path, 0, page_count)
+
+    step = -(-page_count // workers)
+    ranges = [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+
+    # Spawn rather than fork, since the caller may have download threads running
+    with ProcessPoolExecutor(max_workers=len(ranges), mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(_extract_page_range, local_path, start, stop) for start, stop in ranges]
+        return [text for future in futures for text in future.result()]
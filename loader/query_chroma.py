@@ -1,13 +1,35 @@
-import os
+import argparse
+import functools
+from typing import Optional, Tuple
+from chromadb.api.models.Collection import Collection
 from dotenv import load_dotenv
-from llama_index.core import VectorStoreIndex, StorageContext
-from llama_index.vector_stores.chroma import ChromaVectorStore
-import chromadb
-from chromadb.config import Settings as ChromaSettings
+from llama_index.core import Settings, get_response_synthesizer
+from llama_index.core.schema import BaseNode, NodeWithScore, TextNode
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from chroma_client import get_client, list_shards, query_shards
+from embeddings import configure_embed_model
 
 load_dotenv()
+configure_embed_model()
 
-def query_chroma_db(persist_directory: str = "chroma_db", query_text: str = None, top_k: int = 5):
+def to_node(document: str, metadata: dict) -> BaseNode:
+    """Rebuild a llama-index node from a chunk stored in Chroma."""
+    try:
+        return metadata_dict_to_node(metadata, text=document)
+    except ValueError:
+        # Chunk written without llama-index node metadata
+        return TextNode(text=document, metadata=metadata)
+
+@functools.lru_cache(maxsize=4)
+def _get_shards(persist_directory: str, folder_id: Optional[str]) -> Tuple[Collection, ...]:
+    """
+    Return the collections to search, looked up once so repeated queries (e.g. from a notebook)
+    only pay for the search. Call _get_shards.cache_clear() to pick up newly ingested folders.
+    """
+    return tuple(list_shards(get_client(persist_directory), folder_id))
+
+def query_chroma_db(persist_directory: str = "chroma_db", query_text: str = None, top_k: int = 5,
+                    folder_id: Optional[str] = None, synthesize: bool = False):
     """
     Query the Chroma database for similar content.
     
@@ -15,64 +37,55 @@ def query_chroma_db(persist_directory: str = "chroma_db", query_text: str = None
         persist_directory: Directory where Chroma database is stored
         query_text: The text to query for
         top_k: Number of results to return
+        folder_id: Only search documents from this Google Drive folder, all folders if not given
+        synthesize: Also have the LLM answer the query from the retrieved chunks
     """
-    # Initialize Chroma client
-    chroma_client = chromadb.PersistentClient(
-        path=persist_directory,
-        settings=ChromaSettings(anonymized_telemetry=False)
-    )
-    
-    # Get the embeddings collection
-    embeddings_collection = chroma_client.get_or_create_collection(
-        "embeddings",
-        configuration={
-            "hnsw": {
-                "num_threads": 2
-            }
-        }
-    )
-    
-    # Create vector store
-    vector_store = ChromaVectorStore(chroma_collection=embeddings_collection)
-    
-    # Create storage context
-    storage_context = StorageContext.from_defaults(vector_store=vector_store)
-    
-    # Create index from vector store
-    index = VectorStoreIndex.from_vector_store(
-        vector_store,
-        storage_context=storage_context
-    )
-    
-    # Create query engine
-    query_engine = index.as_query_engine(similarity_top_k=top_k)
-    
     # If no query text is provided, use a default query
     if not query_text:
         query_text = "What documents have been processed?"
     
-    # Get response
-    response = query_engine.query(query_text)
+    # Search the folder's collection, or every collection, and merge the results
+    query_embedding = Settings.embed_model.get_query_embedding(query_text)
+    matches = query_shards(_get_shards(persist_directory, folder_id), [query_embedding], top_k)[0]
+    source_nodes = [
+        NodeWithScore(node=to_node(document, metadata), score=1 - distance)
+        for distance, document, metadata in matches
+    ]
     
-    # Print the response
-    print(f"\nQuery: {query_text}")
-    print(f"\nResponse: {response.response}")
+    lines = [f"\nQuery: {query_text}"]
     
-    # Print source nodes (chunks) with their metadata
-    print("\nSource chunks:")
-    for i, node in enumerate(response.source_nodes):
-        print(f"\nChunk {i+1}:")
-        print(f"Score: {node.score}")
-        print(f"Source: {node.metadata.get('source', 'Unknown')}")
-        print(f"Content: {node.text}...")  # Print first 200 chars of content
+    # Only call the LLM when a prose answer is asked for
+    if synthesize:
+        response = get_response_synthesizer().synthesize(query_text, source_nodes)
+        lines.append(f"\nResponse: {response.response}")
+    
+    # Source nodes (chunks) with their metadata, first 200 chars of content
+    lines.append("\nSource chunks:")
+    for i, node in enumerate(source_nodes):
+        lines.append(
+            f"\nChunk {i+1}:\n"
+            f"Score: {node.score}\n"
+            f"File: {node.metadata.get('file_name', 'Unknown')}\n"
+            f"Source: {node.metadata.get('source', 'Unknown')}\n"
+            f"Content: {node.text[:200]}..."
+        )
+    
+    # Print everything at once
+    print("\n".join(lines))
 
 if __name__ == "__main__":
-    # Example usage
-    # You can provide your own query or use the default
-    query_chroma_db(query_text="What is Bakra Beverage")
+    parser = argparse.ArgumentParser(description="Search the processed documents")
+    parser.add_argument("query", nargs="?", default="What is Bakra Beverage", help="The text to query for")
+    parser.add_argument("--top-k", type=int, default=5, help="Number of results to return")
+    parser.add_argument("--folder-id", help="Only search documents from this Google Drive folder")
+    parser.add_argument("--persist-directory", default="chroma_db", help="Directory where Chroma database is stored")
+    parser.add_argument("--synthesize", action="store_true", help="Also have the LLM answer the query from the retrieved chunks")
+    args = parser.parse_args()
     
-    # To see all documents that have been processed
-    # query_chroma_db(query_text="List all documents that have been processed")
-    
-    # To search for specific content
-    # query_chroma_db(query_text="What does the document say about machine learning?") 
\ No newline at end of file
+    query_chroma_db(
+        persist_directory=args.persist_directory,
+        query_text=args.query,
+        top_k=args.top_k,
+        folder_id=args.folder_id,
+        synthesize=args.synthesize,
+    )
@@ -1,63 +1,217 @@
+import os
+import sys
 from mcp.server.fastmcp import FastMCP
-import chromadb
-from chromadb.config import Settings
-from llama_index.vector_stores.chroma import ChromaVectorStore
-from llama_index.core import StorageContext, VectorStoreIndex
-from typing import List, Dict, Any
+from chromadb.api.models.Collection import Collection
+from typing import Callable, List, Dict, Any, Optional, Tuple, Union
 from dotenv import load_dotenv
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import inspect
+import threading
+import time
+import traceback
 import unicodedata
 
+# Import the loader modules by name, as the loader scripts do; appended so this repo's mcp directory
+# doesn't shadow the mcp SDK
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "loader"))
+from embeddings import configure_embed_model, embed_queries
+from query_cache import QueryCache
+from chroma_client import HNSW_CONFIGURATION, get_client, list_shards, query_shards
+from faiss_index import FaissIndex
+from normalization import ensure_normalized
+
 # Load environment variables
 load_dotenv()
 
+# Queries must be embedded with the same model used at ingestion
+configure_embed_model()
+
 # Initialize MCP server
 mcp = FastMCP("Vero Search Server")
 
-# Initialize ChromaDB client
-chroma_client = chromadb.Client(Settings(
-    persist_directory="chroma_db",
-    is_persistent=True
-))
-embeddings_collection = chroma_client.get_or_create_collection(
-    "embeddings",
-    configuration={
-        "hnsw": {
-            "num_threads": 2
-        }
-    }
-)
-vector_store = ChromaVectorStore(chroma_collection=embeddings_collection)
-storage_context = StorageContext.from_defaults(vector_store=vector_store)
+# Initialize ChromaDB client, shared with the loader modules
+chroma_client = get_client("chroma_db")
+
+# Collection handles are reused across tool calls, collections created by the loader
+# are picked up after SHARD_REFRESH_SECONDS
+SHARD_REFRESH_SECONDS = 60
+_shards: Dict[Optional[str], Tuple[float, List[Union[Collection, FaissIndex]]]] = {}
+
+# Search in-memory FAISS copies of the collections instead of Chroma (requires faiss-cpu):
+# "1"/"sq8" for 8-bit quantized vectors, "flat" for full precision ones
+FAISS_INDEX = os.getenv("MCP_FAISS_INDEX", "").lower()
+USE_FAISS_INDEX = FAISS_INDEX in ("1", "true", "sq8", "flat")
+_faiss_indexes: Dict[str, FaissIndex] = {}
+_faiss_lock = threading.Lock()
+
+def get_faiss_index(shard: Collection) -> FaissIndex:
+    """Return the FAISS copy of a collection, rebuilding it when the collection has changed."""
+    with _faiss_lock:
+        index = _faiss_indexes.get(shard.name)
+        if index is None or index.count() != shard.count():
+            hnsw = HNSW_CONFIGURATION["hnsw"]
+            index = FaissIndex(
+                shard, hnsw["max_neighbors"], hnsw["ef_construction"], hnsw["ef_search"],
+                quantized=FAISS_INDEX != "flat"
+            )
+            _faiss_indexes[shard.name] = index
+        return index
+
+def get_shards(folder_id: Optional[str]) -> List[Union[Collection, FaissIndex]]:
+    """Return the collections to search for folder_id, or all collections if None, listing them at most once per refresh period."""
+    cached = _shards.get(folder_id)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    
+    shards = list_shards(chroma_client, folder_id)
+    if USE_FAISS_INDEX:
+        shards = [get_faiss_index(shard) for shard in shards]
+    _shards[folder_id] = (time.monotonic() + SHARD_REFRESH_SECONDS, shards)
+    return shards
+
+# Cache of recent search results, agents often repeat the same query
+query_cache = QueryCache(max_size=2000, ttl_seconds=600)
+
+def cache_key(query: str, n_results: int, folder_id: Optional[str]) -> Tuple[str, int, Optional[str]]:
+    """Build the cache key for a search, ignoring case and surrounding whitespace."""
+    return (unicodedata.normalize('NFKC', query).strip().lower(), n_results, folder_id)
+
+def search_batch(queries: List[str], n_results: int, folder_id: Optional[str]) -> List[List[str]]:
+    """Return the text of the chunks most similar to each query. Blocking, run it in an executor."""
+    # Embed the queries concurrently, then search them all with one query per collection
+    query_embeddings = embed_queries(queries)
+    matches = query_shards(get_shards(folder_id), query_embeddings, n_results)
+    
+    # Chunks are normalized at ingest, only older chunks are normalized here
+    return [
+        [ensure_normalized(document, metadata) for _, document, metadata in query_matches]
+        for query_matches in matches
+    ]
+
+# Blocking embedding and Chroma calls run here, so the stdio event loop keeps reading requests
+_search_pool = ThreadPoolExecutor(max_workers=4)
+
+def warm_up() -> None:
+    """Load the embedding model and the collections' HNSW indexes, so the first search doesn't pay for it."""
+    try:
+        search_batch(["warmup"], 1, None)
+    except Exception as e:
+        # stdout carries the MCP protocol
+        print(f"Search warmup failed: {e}", file=sys.stderr)
+
+class BatchingScheduler:
+    """Coalesces searches arriving within a short window into concurrent query embeddings and one Chroma query per collection."""
+
+    def __init__(self, window_seconds: float = 0.005):
+        """Initialize the scheduler, searches wait up to window_seconds for others to batch with."""
+        self.window_seconds = window_seconds
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def search(self, query: str, n_results: int, folder_id: Optional[str]) -> List[str]:
+        """Queue a search and wait for its results."""
+        loop = asyncio.get_running_loop()
+        
+        # The queue and worker belong to the event loop they were created in
+        if self._worker is None or self._worker.done() or self._worker.get_loop() is not loop:
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+        
+        future = loop.create_future()
+        await self._queue.put((query, n_results, folder_id, future))
+        return await future
+
+    async def _run(self) -> None:
+        """Drain the queue, running the searches collected during each window together."""
+        while True:
+            requests = [await self._queue.get()]
+            await asyncio.sleep(self.window_seconds)
+            while not self._queue.empty():
+                requests.append(self._queue.get_nowait())
+            
+            # Searches can only share a Chroma query if they ask for the same results
+            groups: Dict[Tuple[int, Optional[str]], List[tuple]] = {}
+            for request in requests:
+                groups.setdefault((request[1], request[2]), []).append(request)
+            
+            await asyncio.gather(*(
+                self._run_group(group, n_results, folder_id)
+                for (n_results, folder_id), group in groups.items()
+            ))
+
+    async def _run_group(self, group: List[tuple], n_results: int, folder_id: Optional[str]) -> None:
+        """Run one batched search and hand each caller its results."""
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                _search_pool, search_batch, [query for query, _, _, _ in group], n_results, folder_id
+            )
+        except Exception as e:
+            for _, _, _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for (_, _, _, future), chunk_texts in zip(group, results):
+            if not future.done():
+                future.set_result(chunk_texts)
+
+scheduler = BatchingScheduler()
+
+def mcp_safe(fn: Callable) -> Callable:
+    """Make a tool return {"error": message} instead of raising, logging the traceback to stderr."""
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as e:
+                traceback.print_exc()
+                return {"error": str(e)}
+        return async_wrapper
+    
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            traceback.print_exc()
+            return {"error": str(e)}
+    return wrapper
 
 @mcp.tool()
-def search_documents(query: str, n_results: int = 3) -> Dict[str, Any]:
+@mcp_safe
+async def search_documents(query: str, n_results: int = 3,
+                           folder_id: Optional[str] = None) -> Union[List[str], Dict[str, str]]:
     """
     Search for related information from internal documents.
     
     Args:
         query: The search query to find relevant documents
         n_results: Number of results to return (default: 3)
+        folder_id: Only search documents from this Google Drive folder (default: all folders)
         
     Returns:
-        Dictionary containing documents, metadata, and distances
+        The text of the most similar chunks, or a dictionary with an error message
     """
-    try:
-        index = VectorStoreIndex.from_vector_store(
-            vector_store,
-            storage_context=storage_context,
-        )
-        
-        # Use retriever instead of query engine
-        retriever = index.as_retriever(similarity_top_k=n_results)
-        source_nodes = retriever.retrieve(query)
-        
-        # Extract text content from the source nodes and normalize Unicode characters
-        chunk_texts = [unicodedata.normalize('NFKC', node.text) for node in source_nodes]
-        
-        return chunk_texts
-    except Exception as e:
-        return {"error": str(e)}
+    key = cache_key(query, n_results, folder_id)
+    cached = query_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    # Concurrent searches are embedded and run together
+    chunk_texts = await scheduler.search(query, n_results, folder_id)
+    
+    query_cache.put(key, chunk_texts)
+    return chunk_texts
+
+@mcp.resource("stats://cache")
+def cache_stats() -> Dict[str, Any]:
+    """Search cache statistics"""
+    return query_cache.stats()
 
 if __name__ == "__main__":
+    warm_up()
     mcp.run(transport='stdio')
-    # print(search_documents("What is Bakra Beverage?"))
\ No newline at end of file
+    # print(asyncio.run(search_documents("What is Bakra Beverage?")))
\ No newline at end of file